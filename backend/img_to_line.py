@@ -1,43 +1,157 @@
-from typing import Tuple, List
+from typing import Tuple, List, Optional
 import cv2
 import numpy as np
-from pathlib import Path
 from skimage.morphology import skeletonize
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components, shortest_path
 import logging
+import os
 import tempfile
-import networkx as nx
+from numba import njit
 
 logger = logging.getLogger(__name__)
 
-def preprocess_image(image_path: Path) -> Tuple[np.ndarray, np.ndarray]:
-    """Read image and convert to HSV."""
-    img = cv2.imread(str(image_path))
+# imdecode flags that decode directly at 1/N resolution (JPEG uses DCT scaling)
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def preprocess_image(data: bytes, reduction: int = 1) -> np.ndarray:
+    """
+    Decode encoded image bytes into a BGR image.
+    Args:
+        data: Encoded image file contents
+        reduction: Decode at 1/reduction of the full size, one of REDUCED_READ_FLAGS
+    """
+    if reduction not in REDUCED_READ_FLAGS:
+        raise ValueError(f"Reduction must be one of {sorted(REDUCED_READ_FLAGS)}")
+    buf = np.frombuffer(data, dtype=np.uint8)
+    img = cv2.imdecode(buf, REDUCED_READ_FLAGS[reduction]) if buf.size else None
     if img is None:
-        raise ValueError(f"Could not read image at {image_path}")
-    
-    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-    return img, hsv
+        raise ValueError("Could not decode image")
+    return img
+
+def downscale_mask(mask: np.ndarray, max_size: Optional[int] = None) -> Tuple[np.ndarray, float]:
+    """
+    Shrink a binary mask so its long edge is at most max_size pixels.
+    INTER_AREA averages blocks and any pixel still touched by the region is kept,
+    so thin lines stay connected.
+    Returns:
+        mask: Boolean mask, possibly downscaled
+        scale: Factor applied to the mask coordinates (1.0 if unchanged)
+    """
+    scale = 1.0 if max_size is None else min(1.0, max_size / max(mask.shape[:2]))
+    if scale < 1.0:
+        mask = cv2.resize(mask, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return mask > 0, scale
 
-def skeleton_to_graph(skeleton: np.ndarray) -> nx.Graph:
+def skeleton_to_graph(skeleton: np.ndarray) -> Tuple[np.ndarray, csr_matrix]:
     """
-    Convert a skeletonized binary image to a graph.
-    Each white pixel is a node, edges connect 8-connected neighbors.
+    Convert a skeletonized binary image to a sparse adjacency matrix.
+    Each white pixel is a node, edges connect 8-connected neighbors. A diagonal
+    edge is dropped when both its pixels touch a common 4-neighbor in the skeleton,
+    so the corner triangles of an 8-connected skeleton don't form cycles.
+    Returns:
+        coords: (N, 2) array of node (x, y) pixel coordinates
+        graph: (N, N) CSR adjacency matrix
     """
-    G = nx.Graph()
     h, w = skeleton.shape
-    for y in range(h):
-        for x in range(w):
-            if skeleton[y, x]:
-                node = (x, y)
-                for dx in [-1, 0, 1]:
-                    for dy in [-1, 0, 1]:
-                        if dx == 0 and dy == 0:
-                            continue
-                        nx_, ny_ = x + dx, y + dy
-                        if 0 <= nx_ < w and 0 <= ny_ < h and skeleton[ny_, nx_]:
-                            neighbor = (nx_, ny_)
-                            G.add_edge(node, neighbor)
-    return G
+    ys, xs = np.nonzero(skeleton)
+    n = len(ys)
+    # Map each skeleton pixel to its node index, with a -1 border so shifts stay in bounds
+    idx = np.full((h + 2, w + 2), -1, np.int32)
+    idx[ys + 1, xs + 1] = np.arange(n, dtype=np.int32)
+
+    src, dst = [], []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx == 0 and dy == 0:
+                continue
+            neighbor = idx[ys + 1 + dy, xs + 1 + dx]
+            valid = neighbor >= 0
+            if dx != 0 and dy != 0:
+                # The path through the shared 4-neighbor replaces the diagonal
+                valid &= (idx[ys + 1 + dy, xs + 1] < 0) & (idx[ys + 1, xs + 1 + dx] < 0)
+            src.append(np.nonzero(valid)[0].astype(np.int32))
+            dst.append(neighbor[valid])
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+
+    order = np.argsort(src, kind='stable')
+    indices = dst[order]
+    indptr = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    coords = np.stack([xs, ys], axis=1).astype(np.int32)
+    graph = csr_matrix((np.ones(len(indices), np.int8), indices, indptr), shape=(n, n))
+    return coords, graph
+
+@njit(cache=True, boundscheck=False)
+def _color_match(img: np.ndarray, x: int, y: int,
+                 sb: int, sg: int, sr: int, thresh2: int) -> bool:
+    """Check whether the pixel at (x, y) is within the squared color distance of the seed."""
+    db = np.int32(img[y, x, 0]) - sb
+    dg = np.int32(img[y, x, 1]) - sg
+    dr = np.int32(img[y, x, 2]) - sr
+    return db * db + dg * dg + dr * dr <= thresh2
+
+@njit(cache=True, boundscheck=False)
+def _fill_run(img: np.ndarray, mask: np.ndarray, x: int, y: int,
+              sb: int, sg: int, sr: int, thresh2: int) -> Tuple[int, int]:
+    """Fill the maximal horizontal run of matching pixels through (x, y) and return its ends."""
+    w = img.shape[1]
+    left = x
+    while left > 0 and mask[y, left - 1] == 0 and _color_match(img, left - 1, y, sb, sg, sr, thresh2):
+        left -= 1
+    right = x
+    while right < w - 1 and mask[y, right + 1] == 0 and _color_match(img, right + 1, y, sb, sg, sr, thresh2):
+        right += 1
+    mask[y, left:right + 1] = 255
+    return left, right
+
+@njit(cache=True, nogil=True, boundscheck=False)
+def _region_grow_nb(img: np.ndarray, sx: int, sy: int, thresh2: int) -> np.ndarray:
+    """
+    Scanline flood fill from (sx, sy) over an 8-connected neighborhood.
+    Every run is filled as soon as it is discovered, so each pixel is written once
+    and the stack holds at most one entry (the flat index of its left end) per run.
+    """
+    h, w = img.shape[0], img.shape[1]
+    mask = np.zeros((h, w), np.uint8)
+    stack = np.empty(h * w, np.int32)
+    sb = np.int32(img[sy, sx, 0])
+    sg = np.int32(img[sy, sx, 1])
+    sr = np.int32(img[sy, sx, 2])
+
+    left, _ = _fill_run(img, mask, sx, sy, sb, sg, sr, thresh2)
+    stack[0] = sy * w + left
+    top = 1
+    while top > 0:
+        top -= 1
+        y = stack[top] // w
+        left = stack[top] - y * w
+        # Runs are maximal, so the filled pixels to the right mark exactly this run
+        right = left
+        while right < w - 1 and mask[y, right + 1] != 0:
+            right += 1
+        # Probe the rows above and below, one pixel wider for diagonal neighbors
+        for ny in (y - 1, y + 1):
+            if ny < 0 or ny >= h:
+                continue
+            x = max(left - 1, 0)
+            end = min(right + 1, w - 1)
+            while x <= end:
+                if mask[ny, x] == 0 and _color_match(img, x, ny, sb, sg, sr, thresh2):
+                    run_left, run_right = _fill_run(img, mask, x, ny, sb, sg, sr, thresh2)
+                    stack[top] = ny * w + run_left
+                    top += 1
+                    # The pixel after a maximal run never matches
+                    x = run_right + 2
+                else:
+                    x += 1
+    return mask
 
 def region_grow(img: np.ndarray, seed: tuple, color_thresh: int = 30) -> np.ndarray:
     """
@@ -50,80 +164,160 @@ def region_grow(img: np.ndarray, seed: tuple, color_thresh: int = 30) -> np.ndar
         mask: Binary mask of the grown region
     """
     h, w, _ = img.shape
-    mask = np.zeros((h, w), np.uint8)
-    visited = np.zeros((h, w), np.bool_)
     # Ensure seed is a tuple (x, y)
     if not (isinstance(seed, tuple) and len(seed) == 2):
         raise ValueError("Seed must be a tuple (x, y)")
     x0, y0 = seed
-    stack = [(x0, y0)]
-    seed_color = img[y0, x0].astype(np.int32)
-    
-    while stack:
-        x, y = stack.pop()
-        if x < 0 or x >= w or y < 0 or y >= h:
-            continue
-        if visited[y, x]:
-            continue
-        visited[y, x] = True
-        color = img[y, x].astype(np.int32)
-        if np.linalg.norm(color - seed_color) <= color_thresh:
-            mask[y, x] = 255
-            # Add 8-connected neighbors
-            for dx in [-1, 0, 1]:
-                for dy in [-1, 0, 1]:
-                    if dx != 0 or dy != 0:
-                        stack.append((x + dx, y + dy))
-    return mask
+    if not (0 <= x0 < w and 0 <= y0 < h):
+        raise ValueError(f"Seed {seed} is outside the image ({w}x{h})")
+    img = np.ascontiguousarray(img, dtype=np.uint8)
+    return _region_grow_nb(img, int(x0), int(y0), int(color_thresh * color_thresh))
+
+def _walk_predecessors(predecessors: np.ndarray, end: int) -> List[int]:
+    """Follow BFS predecessors from end back to the root (negative predecessor)."""
+    path = [end]
+    while predecessors[path[-1]] >= 0:
+        path.append(predecessors[path[-1]])
+    return path
 
-def find_longest_path(G: nx.Graph) -> list:
+def _contract_chains(graph: csr_matrix) -> Tuple[np.ndarray, csr_matrix]:
     """
-    Find the longest simple path in the graph using all pairs shortest path.
+    Contract every chain of degree-2 nodes into one weighted edge between the
+    junctions or endpoints at its ends, keeping the shortest of parallel edges.
+    Returns:
+        keys: Original index of each remaining (degree != 2) node
+        contracted: (K, K) CSR matrix of hop counts between neighboring keys
     """
-    if len(G.nodes) == 0:
+    n = graph.shape[0]
+    is_key = np.diff(graph.indptr) != 2
+    keys = np.flatnonzero(is_key)
+    key_id = np.full(n, -1, np.int64)
+    key_id[keys] = np.arange(len(keys))
+    src = np.repeat(np.arange(n), np.diff(graph.indptr))
+    dst = graph.indices
+
+    # Chains are the components of the graph without its key nodes
+    chain_nodes = np.flatnonzero(~is_key)
+    n_chains, labels = connected_components(graph[chain_nodes][:, chain_nodes], directed=False)
+    chain_id = np.full(n, -1, np.int64)
+    chain_id[chain_nodes] = labels
+    sizes = np.bincount(labels, minlength=n_chains)
+
+    # Each open chain has exactly two edges into key nodes, closed loops have none
+    into_key = ~is_key[src] & is_key[dst]
+    chains = chain_id[src[into_key]]
+    order = np.argsort(chains, kind='stable')
+    ends = key_id[dst[into_key]][order].reshape(-1, 2)
+    chain_len = sizes[chains[order][::2]] + 1
+    # A chain that leaves and returns to the same key is never on a shortest path
+    open_chain = ends[:, 0] != ends[:, 1]
+    ends, chain_len = ends[open_chain], chain_len[open_chain]
+
+    direct = is_key[src] & is_key[dst]
+    u = np.concatenate([key_id[src[direct]], ends[:, 0], ends[:, 1]])
+    v = np.concatenate([key_id[dst[direct]], ends[:, 1], ends[:, 0]])
+    weight = np.concatenate([np.ones(direct.sum(), np.int64), chain_len, chain_len])
+    # csr_matrix sums duplicate entries, so keep only the shortest edge per key pair
+    order = np.lexsort((weight, v, u))
+    u, v, weight = u[order], v[order], weight[order]
+    first = np.ones(len(u), bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    contracted = csr_matrix((weight[first].astype(np.float64), (u[first], v[first])),
+                            shape=(len(keys), len(keys)))
+    return keys, contracted
+
+def _longest_endpoint_path(graph: csr_matrix, endpoints: np.ndarray,
+                           chunk_size: int = 64) -> List[int]:
+    """
+    Longest shortest path between any two endpoints, by Dijkstra from every endpoint
+    over the chain-contracted graph, then one BFS over the pixels to recover the path.
+    Sources are processed in chunks to bound the distance matrix memory.
+    """
+    keys, contracted = _contract_chains(graph)
+    key_endpoints = np.searchsorted(keys, endpoints)
+    best_len, best_src, best_dst = 0, -1, -1
+    for i in range(0, len(endpoints), chunk_size):
+        sources = key_endpoints[i:i + chunk_size]
+        dist = shortest_path(contracted, method='D', directed=False, indices=sources)[:, key_endpoints]
+        # Endpoints in other components are unreachable
+        dist[~np.isfinite(dist)] = -1
+        # The first maximum in row-major order has the lower endpoint as its source
+        row, col = np.unravel_index(np.argmax(dist), dist.shape)
+        if dist[row, col] > best_len:
+            best_len, best_src, best_dst = dist[row, col], endpoints[i + row], endpoints[col]
+    if best_src < 0:
         return []
-    # Only use nodes that are tuples of length 2
-    tuple_nodes = [n for n in G.nodes if isinstance(n, tuple) and len(n) == 2]
-    # Find all endpoints (nodes with degree 1) among tuple nodes
-    endpoints = [n for n in tuple_nodes if G.degree[n] == 1]
-    max_path = []
-    for i in range(len(endpoints)):
-        for j in range(i+1, len(endpoints)):
-            try:
-                path = nx.shortest_path(G, endpoints[i], endpoints[j])
-                if isinstance(path, list) and len(path) > len(max_path):
-                    max_path = path
-            except nx.NetworkXNoPath:
-                continue
-    return max_path
+    _, predecessors = breadth_first_order(graph, int(best_src), return_predecessors=True)
+    return _walk_predecessors(predecessors, best_dst)
 
-def detect_path(img: np.ndarray, hsv: np.ndarray, 
-                start_x: int, start_y: int) -> List[np.ndarray]:
-    """Find path starting from given point using region growing and graph-based extraction."""
+def find_longest_path(coords: np.ndarray, graph: csr_matrix) -> np.ndarray:
+    """
+    Find the longest shortest path between two endpoints (degree-1 nodes) of the
+    skeleton graph. A skeleton without endpoints, such as a closed loop, has no path.
+    
+    When the skeleton is a single tree, the two-pass BFS (tree diameter) algorithm
+    finds it exactly: the farthest node from an endpoint is one end, the farthest
+    node from that end is the other. Two-pass BFS is only approximate on graphs
+    with cycles or several components, so those fall back to a search from every
+    endpoint over the graph with its pixel chains contracted.
+    Returns:
+        (N, 2) array of (x, y) coordinates along the path, starting from the end
+        that comes first in row-major order
+    """
+    endpoints = np.flatnonzero(np.diff(graph.indptr) == 1)
+    if len(endpoints) == 0:
+        return np.empty((0, 2), np.int32)
+    
+    n_edges = graph.nnz // 2
+    is_tree = (n_edges == len(coords) - 1
+               and connected_components(graph, directed=False, return_labels=False) == 1)
+    if is_tree:
+        # BFS visits nodes in order of distance, so the last one is the farthest
+        order = breadth_first_order(graph, int(endpoints[0]), return_predecessors=False)
+        order, predecessors = breadth_first_order(graph, order[-1], return_predecessors=True)
+        path = _walk_predecessors(predecessors, order[-1])
+    else:
+        path = _longest_endpoint_path(graph, endpoints)
+    # Nodes are numbered in row-major order, so orient the path from its lower end
+    if len(path) and path[0] > path[-1]:
+        path.reverse()
+    return coords[path].reshape(-1, 2)
+
+def detect_path(img: np.ndarray, start_x: int, start_y: int,
+                max_size: Optional[int] = None, debug: bool = False) -> List[np.ndarray]:
+    """
+    Find path starting from given point using region growing and graph-based extraction.
+    The region is grown at full resolution; when max_size is given, its mask is
+    downscaled to at most max_size pixels on the long edge before skeletonization.
+    When debug is set, the grown mask with the detected path is written to a new
+    file in the temp directory.
+    """
     start_point = (start_x, start_y)
     
     # Use region growing to extract the route
     mask = region_grow(img, start_point, color_thresh=30)
     
-    # Skeletonize the mask
-    skeleton = skeletonize(mask > 0)
+    # Crop to the grown region's bounding box; the region always contains
+    # the seed, so the box is never empty
+    x, y, w, h = cv2.boundingRect(mask)
+    region, scale = downscale_mask(mask[y:y + h, x:x + w], max_size)
+    
+    # Skeletonize the mask, with a 1-px background border
+    skeleton = skeletonize(np.pad(region, 1))
     
     # Convert skeleton to graph
-    G = skeleton_to_graph(skeleton)
+    coords, graph = skeleton_to_graph(skeleton)
     
     # Find the longest path in the graph
-    path = find_longest_path(G)
-
-    # Filter out any non-tuple elements robustly
-    filtered_path = []
-    for p in path:
-        if isinstance(p, tuple) and len(p) == 2 and all(isinstance(coord, int) for coord in p):
-            filtered_path.append([p[0], p[1]])
-        else:
-            logger.warning(f"Non-tuple or invalid path element encountered: {p}")
-
-    if filtered_path:
-        contour = np.array(filtered_path, dtype=np.int32).reshape(-1, 1, 2)
+    path = find_longest_path(coords, graph) - 1
+    if scale < 1.0:
+        # Map downscaled pixel centers back to crop pixels
+        path = np.round((path + 0.5) / scale - 0.5).astype(np.int32)
+    # Shift back to image coordinates
+    path += np.array([x, y], dtype=path.dtype)
+
+    if len(path):
+        contour = path.reshape(-1, 1, 2)
         contours = [contour]
         
         # Simplify the contours
@@ -139,13 +333,15 @@ def detect_path(img: np.ndarray, hsv: np.ndarray,
     else:
         contours = []
     
-    # Save debug image
-    debug_img = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-    cv2.polylines(debug_img, contours, False, (0, 255, 0), 2)
-    cv2.circle(debug_img, (start_x, start_y), 5, (0, 0, 255), -1)
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-        debug_path = Path(tmp.name)
-        cv2.imwrite(str(debug_path), debug_img)
+    if debug:
+        # Save debug image under a unique name so concurrent detections don't collide;
+        # fast PNG compression
+        debug_img = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+        cv2.polylines(debug_img, contours, False, (0, 255, 0), 2)
+        cv2.circle(debug_img, (start_x, start_y), 5, (0, 0, 255), -1)
+        fd, debug_path = tempfile.mkstemp(prefix='img_to_gpx_debug_', suffix='.png')
+        os.close(fd)
+        cv2.imwrite(debug_path, debug_img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
         logger.info(f"Debug image saved: {debug_path}")
     
     return contours
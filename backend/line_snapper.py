@@ -1,8 +1,12 @@
 import requests
 import logging
 import os
+import numpy as np
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from typing import List, Tuple
+from requests.adapters import HTTPAdapter
 
 # Configure logging
 log_dir = "logs"
@@ -12,9 +16,10 @@ if not os.path.exists(log_dir):
 # Use a single log file that gets overwritten
 log_file = os.path.join(log_dir, "line_snapper.log")
 
-# Configure logging to write to both file and console
+# Configure logging to write to both file and console; LOG_LEVEL=DEBUG also
+# dumps the full Valhalla request and response payloads
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.FileHandler(log_file, mode='w'),  # 'w' mode overwrites the file
@@ -24,6 +29,14 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Number of recent snapping results kept per LineSnapper
+SNAP_CACHE_SIZE = 16
+
+# Shared keep-alive session so cache misses reuse the Valhalla connection
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 class LineSnapper:
     def __init__(self, valhalla_url: str = "http://localhost:8002"):
         """Initialize the line snapper with Valhalla HTTP API URL.
@@ -32,12 +45,19 @@ class LineSnapper:
             valhalla_url: URL of the Valhalla HTTP API service
         """
         self.valhalla_url = valhalla_url
+        # LRU of matched shapes as float64 bytes, keyed on quantized input points
+        self._cache: "OrderedDict[Tuple[bytes, float], bytes]" = OrderedDict()
+        self._cache_lock = threading.Lock()
         logger.info(f"Initialized LineSnapper with Valhalla URL: {valhalla_url}")
         logger.info(f"Log file: {log_file}")
 
     def snap_points(self, points: List[Tuple[float, float]], radius: float = 10) -> List[Tuple[float, float]]:
         """Snap a list of points to the road network.
         
+        Results are cached on the points rounded to 5 decimals (~1 m), so a
+        trace within that distance of a recent one returns the earlier match.
+        Valhalla always receives the original, unrounded points.
+        
         Args:
             points: List of (latitude, longitude) tuples
             radius: Search radius in meters for finding nearby roads
@@ -45,6 +65,53 @@ class LineSnapper:
         Returns:
             List of snapped (latitude, longitude) tuples
         """
+        logger.info(f"First point: {points[0] if points else 'No points'}")
+        logger.info(f"Last point: {points[-1] if points else 'No points'}")
+        
+        # _request_snap always searches a fixed 100 m, so radius is not part of the key
+        key = np.round(np.asarray(points, dtype=np.float64), 5).tobytes()
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        
+        if cached is not None:
+            logger.info("Using cached Valhalla match")
+            matched_points = np.frombuffer(cached, dtype=np.float64).reshape(-1, 2)
+        else:
+            try:
+                matched_points = self._request_snap(points, radius)
+            except Exception as e:
+                logger.error(f"Error snapping points: {str(e)}", exc_info=True)
+                # If request fails, return original points
+                return points
+            # Only successful matches are cached
+            with self._cache_lock:
+                self._cache[key] = matched_points.tobytes()
+                self._cache.move_to_end(key)
+                if len(self._cache) > SNAP_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        
+        # Log comparison of first and last points
+        if points:
+            logger.info("First point comparison:")
+            logger.info(f"Original: ({points[0][0]:.6f}, {points[0][1]:.6f})")
+            logger.info(f"Matched:  ({matched_points[0][0]:.6f}, {matched_points[0][1]:.6f})")
+            logger.info("Last point comparison:")
+            logger.info(f"Original: ({points[-1][0]:.6f}, {points[-1][1]:.6f})")
+            logger.info(f"Matched:  ({matched_points[-1][0]:.6f}, {matched_points[-1][1]:.6f})")
+        
+        return list(zip(matched_points[:, 0].tolist(), matched_points[:, 1].tolist()))
+
+    def _request_snap(self, points: List[Tuple[float, float]], radius: float) -> np.ndarray:
+        """Match points against Valhalla's trace_attributes endpoint.
+        
+        Returns:
+            (N, 2) float64 array of snapped (latitude, longitude) pairs
+            
+        Raises:
+            ValueError: If Valhalla returned no matched shape
+        """
         # Increase search radius to 100 meters
         search_radius = 100
         
@@ -74,77 +141,37 @@ class LineSnapper:
         }
         
         logger.info(f"Sending request to Valhalla with {len(points)} points")
-        logger.info(f"First point: {points[0] if points else 'No points'}")
-        logger.info(f"Last point: {points[-1] if points else 'No points'}")
-        logger.debug(f"Request payload: {request}")
+        logger.debug("Request payload: %s", request)
         
-        try:
-            # Get the snapped locations using trace_attributes endpoint
-            response = requests.post(f"{self.valhalla_url}/trace_attributes", json=request)
-            response.raise_for_status()
-            result = response.json()
-            
-            logger.debug(f"Valhalla response: {result}")
-            
-            if result and "shape" in result:
-                # Decode the polyline shape
-                matched_points = self._decode_polyline(result["shape"])
-                logger.info(f"Successfully matched {len(matched_points)} points")
-                
-                # Log comparison of first and last points
-                if points and matched_points:
-                    logger.info("First point comparison:")
-                    logger.info(f"Original: ({points[0][0]:.6f}, {points[0][1]:.6f})")
-                    logger.info(f"Matched:  ({matched_points[0][0]:.6f}, {matched_points[0][1]:.6f})")
-                    logger.info("Last point comparison:")
-                    logger.info(f"Original: ({points[-1][0]:.6f}, {points[-1][1]:.6f})")
-                    logger.info(f"Matched:  ({matched_points[-1][0]:.6f}, {matched_points[-1][1]:.6f})")
-                
-                return matched_points
-            else:
-                logger.warning("No shape found in Valhalla response, returning original points")
-                logger.warning(f"Response content: {result}")
-                return points
-        except Exception as e:
-            logger.error(f"Error snapping points: {str(e)}", exc_info=True)
-            # If request fails, return original points
-            return points
+        # Get the snapped locations using trace_attributes endpoint
+        response = _session.post(f"{self.valhalla_url}/trace_attributes", json=request)
+        response.raise_for_status()
+        result = response.json()
+        
+        logger.debug("Valhalla response: %s", result)
+        
+        matched_points = self._decode_polyline(result["shape"]) if result and "shape" in result else None
+        if matched_points is None or len(matched_points) == 0:
+            raise ValueError(f"No shape found in Valhalla response: {result}")
+        
+        logger.info(f"Successfully matched {len(matched_points)} points")
+        return matched_points
 
-    def _decode_polyline(self, encoded: str) -> List[Tuple[float, float]]:
-        """Decode a Google-style polyline string into a list of lat/lon tuples."""
-        # Initialize variables
-        index = 0
-        lat = 0
-        lng = 0
-        points = []
-        
-        while index < len(encoded):
-            # Decode latitude
-            shift = 0
-            result = 0
-            while True:
-                byte = ord(encoded[index]) - 63
-                index += 1
-                result |= (byte & 0x1F) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-            lat += (~(result >> 1) if (result & 1) else (result >> 1))
-            
-            # Decode longitude
-            shift = 0
-            result = 0
-            while True:
-                byte = ord(encoded[index]) - 63
-                index += 1
-                result |= (byte & 0x1F) << shift
-                shift += 5
-                if not byte >= 0x20:
-                    break
-            lng += (~(result >> 1) if (result & 1) else (result >> 1))
-            
-            # Convert to actual lat/lon values (divide by 1e5)
-            # Note: Valhalla uses 1e6 for polyline encoding
-            points.append((lat * 1e-6, lng * 1e-6))
+    def _decode_polyline(self, encoded: str) -> np.ndarray:
+        """Decode a Google-style polyline string into an (N, 2) array of lat/lon pairs."""
+        if not encoded:
+            return np.empty((0, 2), dtype=np.float64)
+        
+        # Each character carries 5 bits of a value, least significant chunk first;
+        # a chunk without the 0x20 continuation bit ends the value
+        chunks = np.frombuffer(encoded.encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+        ends = np.flatnonzero(chunks < 0x20)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        position = np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1)
+        values = np.add.reduceat((chunks & 0x1F) << (5 * position), starts)
         
-        return points
+        # Undo the zigzag sign encoding and the per-point delta encoding
+        values = np.where(values & 1, ~(values >> 1), values >> 1)
+        # Convert to actual lat/lon values (divide by 1e6)
+        # Note: Valhalla uses 1e6 for polyline encoding
+        return np.cumsum(values.reshape(-1, 2), axis=0) * 1e-6
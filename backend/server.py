@@ -1,13 +1,13 @@
-from flask import Flask, send_from_directory, request, jsonify, Response
+from flask import Flask, send_from_directory, request, Response
 from flask_cors import CORS
+import orjson
 import os
-import tempfile
 from pathlib import Path
 import sys
 from typing import Tuple, Union, Any, List
 import numpy as np
 sys.path.append(str(Path(__file__).parent))
-from img_to_line import preprocess_image, detect_path
+from img_to_line import preprocess_image, detect_path, REDUCED_READ_FLAGS
 from line_snapper import LineSnapper
 import logging
 
@@ -40,11 +40,37 @@ CORS(app, resources={
 VALHALLA_URL = os.getenv("VALHALLA_URL", "http://localhost:8002")
 line_snapper = LineSnapper(VALHALLA_URL)
 
+# Long-edge size (in pixels) that the route mask is downscaled to before skeletonization
+MAX_DETECTION_SIZE = int(os.getenv("MAX_DETECTION_SIZE", "1024"))
+
+# Write a debug image of each detection to the temp directory
+DEBUG_IMAGES = os.getenv("DEBUG_IMAGES", "0") == "1"
+
 def create_response(data: Any, status_code: int = 200) -> Tuple[Response, int]:
     """Create a standardized response with proper CORS headers."""
-    response = jsonify(data)
+    # orjson serializes NumPy arrays and scalars natively, no .tolist() needed
+    response = Response(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY),
+                        mimetype='application/json')
     return response, status_code
 
+def extract_contours(data: bytes, start_x: int, start_y: int,
+                     reduction: int = 1) -> List[np.ndarray]:
+    """Decode the image and detect the path starting at the given point."""
+    img = preprocess_image(data, reduction)
+    # Floor division maps the seed into the reduced pixel that contains it
+    seed_x, seed_y = start_x // reduction, start_y // reduction
+    h, w = img.shape[:2]
+    if not (0 <= seed_x < w and 0 <= seed_y < h):
+        # A seed outside the image is a client error, reported as no points found
+        logger.info(f"Start point ({start_x}, {start_y}) is outside the image")
+        return []
+    
+    contours = detect_path(img, seed_x, seed_y, max_size=MAX_DETECTION_SIZE, debug=DEBUG_IMAGES)
+    if reduction == 1:
+        return contours
+    # Map reduced pixel centers back to original pixels
+    return [np.round((c + 0.5) * reduction - 0.5).astype(np.int32) for c in contours]
+
 @app.route('/')
 def serve_frontend() -> Response:
     """Serve the frontend index.html file."""
@@ -64,34 +90,26 @@ def generate_points() -> Tuple[Response, int]:
     image_file = request.files['image']
     start_x = request.form.get('start_x', type=int)
     start_y = request.form.get('start_y', type=int)
+    # Optional fast preview: decode the image at 1/reduction resolution
+    reduction = request.form.get('reduction', '1')
+    reduction = int(reduction) if reduction.isdecimal() else None
     
     if start_x is None or start_y is None:
         return create_response({'error': 'Missing start_x or start_y'}, 400)
-
-    # Save to temp file
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-        image_file.save(tmp.name)
-        tmp_path = Path(tmp.name)
+    if reduction not in REDUCED_READ_FLAGS:
+        return create_response({'error': f'reduction must be one of {sorted(REDUCED_READ_FLAGS)}'}, 400)
 
     try:
-        img, hsv = preprocess_image(tmp_path)
-        contours = detect_path(img, hsv, start_x, start_y)
+        contours = extract_contours(image_file.read(), start_x, start_y, reduction)
         
-        # Convert contours to points
-        points = []
-        for contour in contours:
-            if len(contour) > 1:
-                # Reshape and convert to list of [x, y] points
-                contour_points = contour.reshape(-1, 2).tolist()
-                points.extend(contour_points)
+        # Convert contours to an (N, 2) array of [x, y] points
+        contour_points = [contour.reshape(-1, 2) for contour in contours if len(contour) > 1]
         
         # Get bounding box for canvas size
-        if points:
-            points_array = np.array(points)
-            min_x = np.min(points_array[:, 0])
-            min_y = np.min(points_array[:, 1])
-            max_x = np.max(points_array[:, 0])
-            max_y = np.max(points_array[:, 1])
+        if contour_points:
+            points = np.concatenate(contour_points)
+            min_x, min_y = points.min(axis=0)
+            max_x, max_y = points.max(axis=0)
             
             # Add padding
             padding = 10
@@ -101,15 +119,14 @@ def generate_points() -> Tuple[Response, int]:
             # Return both original and normalized points
             return create_response({
                 'points': points,  # Original points
-                'normalized_points': [[float(x - min_x + padding), float(y - min_y + padding)] 
-                                    for x, y in points],
-                'width': int(width),
-                'height': int(height),
+                'normalized_points': (points - [min_x - padding, min_y - padding]).astype(np.float64),
+                'width': width,
+                'height': height,
                 'bounds': {
-                    'min_x': int(min_x),
-                    'min_y': int(min_y),
-                    'max_x': int(max_x),
-                    'max_y': int(max_y)
+                    'min_x': min_x,
+                    'min_y': min_y,
+                    'max_x': max_x,
+                    'max_y': max_y
                 }
             })
         else:
@@ -118,13 +135,6 @@ def generate_points() -> Tuple[Response, int]:
     except Exception as e:
         logger.error(f"Error generating points: {str(e)}", exc_info=True)
         return create_response({'error': str(e)}, 500)
-        
-    finally:
-        # Cleanup temporary files
-        try:
-            os.remove(tmp_path)
-        except Exception as e:
-            logger.warning(f"Error cleaning up temporary files: {str(e)}")
 
 @app.route('/api/snap-points', methods=['POST'])
 def snap_points() -> Tuple[Response, int]:
@@ -144,4 +154,7 @@ def snap_points() -> Tuple[Response, int]:
         return create_response({'error': str(e)}, 500)
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5131) 
+    # Development server only. In production run under gunicorn, e.g.
+    #   gunicorn -w $(nproc) -k gthread --threads 4 -b 0.0.0.0:5131 --preload server:app
+    # --preload imports OpenCV/NumPy/skimage once before forking the workers.
+    app.run(debug=True, port=5131)